@@ -42,10 +42,21 @@ if not args.input_dir.endswith("/"):
 assert len(args.separator) == 1
 
 
+# compiled once at import, wikitext_detokenizer is called on every document
+wikitext_contraction_re = re.compile(r"/' [0-9]/")
+wikitext_bracket_res = [
+    (re.compile(r"\(\s*([^\)]*?)\s*\)"), r"(\1)"),
+    (re.compile(r"\[\s*([^\]]*?)\s*\]"), r"[\1]"),
+    (re.compile(r"{\s*([^}]*?)\s*}"), r"{\1}"),
+    (re.compile(r"\"\s*([^\"]*?)\s*\""), r'"\1"'),
+    (re.compile(r"'\s*([^']*?)\s*'"), r"'\1'"),
+]
+
+
 def wikitext_detokenizer(string):
     # contractions
     string = string.replace("s '", "s'")
-    string = re.sub(r"/' [0-9]/", r"/'[0-9]/", string)
+    string = wikitext_contraction_re.sub(r"/'[0-9]/", string)
     # number separators
     string = string.replace(" @-@ ", "-")
     string = string.replace(" @,@ ", ",")
@@ -58,11 +69,8 @@ def wikitext_detokenizer(string):
     string = string.replace(" ? ", "? ")
     string = string.replace(" , ", ", ")
     # double brackets
-    string = re.sub(r"\(\s*([^\)]*?)\s*\)", r"(\1)", string)
-    string = re.sub(r"\[\s*([^\]]*?)\s*\]", r"[\1]", string)
-    string = re.sub(r"{\s*([^}]*?)\s*}", r"{\1}", string)
-    string = re.sub(r"\"\s*([^\"]*?)\s*\"", r'"\1"', string)
-    string = re.sub(r"'\s*([^']*?)\s*'", r"'\1'", string)
+    for pattern, replacement in wikitext_bracket_res:
+        string = pattern.sub(replacement, string)
     # miscellaneous
     string = string.replace("= = = =", "====")
     string = string.replace("= = =", "===")
@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from tokenizers import Tokenizer
 from transformers import GPT2Tokenizer, GPT2TokenizerFast
 
@@ -9,7 +11,12 @@ def fetch_encoder(params):
     dataset = next(iter(params['dataset_configs'].values())) # Get the first value from the dict
     path = dataset["tokenizer_path"]
     is_pretrained = dataset.get("tokenizer_is_pretrained", False)
+    return _get_enc(path, is_pretrained)
+
 
+# Loading a tokenizer parses its vocab and merges files, so each one is only loaded once per process
+@lru_cache(maxsize=4)
+def _get_enc(path, is_pretrained):
     if is_pretrained:
         tok = GPT2TokenizerFast.from_pretrained(path)
 
@@ -26,3 +33,12 @@ def encode(encoder, text):
     if isinstance(result, list):
         return result
     return result.ids
+
+
+# Encodes a list of texts in one call, letting the Rust tokenizers parallelize the work
+def encode_batch(encoder, texts):
+    if isinstance(encoder, Tokenizer):
+        return [result.ids for result in encoder.encode_batch(texts)]
+    if isinstance(encoder, GPT2TokenizerFast):
+        return encoder(texts, add_special_tokens=False)['input_ids']
+    return [encode(encoder, text) for text in texts]
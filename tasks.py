@@ -1,15 +1,46 @@
 import os.path
+import tempfile
 import json
+import hashlib
+import itertools
 import requests
 import numpy as np
 import ftfy
-from data.encoders import fetch_encoder, encode
+from data.encoders import fetch_encoder, encode_batch
 import tensorflow as tf
 import re
-from functools import partial
+from functools import partial, lru_cache
+from multiprocessing import Pool
 
 lambada_src_uri = 'http://eaidata.bmk.sh/data/lambada_test.jsonl'
 normalization = 'NFKC'
+# below this many texts the process pool costs more than it saves
+parallel_fix_text_threshold = 1000
+
+
+def atomic_save(path, save_fn):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save_fn(f)
+        # mkstemp creates the file as 0600, give it the mode a plain open() would have
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_path, 0o666 & ~umask)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
+@lru_cache(maxsize=8)
+def _md5_hexdigest(string):
+    return hashlib.md5(string.encode()).hexdigest()
+
+
+def _tokenizer_hash(params):
+    ds_config = next(iter(params['dataset_configs'].values()))
+    return _md5_hexdigest(ds_config['tokenizer_path'])
 
 
 # Note: this task is called "lambada" but it really refers to OpenAI's version
@@ -20,44 +51,121 @@ normalization = 'NFKC'
 #   https://github.com/openai/gpt-2/issues/131
 
 def lambada_create_tokens_data(params, path):
-    with open(path, 'w') as f:
-        req = requests.get(lambada_src_uri)
+    with requests.get(lambada_src_uri, stream=True) as req:
         req.raise_for_status()
-        jsons = [json.loads(l) for l in req.iter_lines()]
-        texts = [ftfy.fix_text(j['text'], normalization=normalization) for j in jsons]
-        enc = fetch_encoder(params)
-        arrays = [encode(enc, t) for t in texts]
-        json.dump(arrays, f)
-        return arrays
+        raw_texts = [json.loads(l)['text'] for l in req.iter_lines() if l]
+    fix_text = partial(ftfy.fix_text, normalization=normalization)
+    if len(raw_texts) > parallel_fix_text_threshold:
+        with Pool() as pool:
+            texts = pool.map(fix_text, raw_texts, chunksize=64)
+    else:
+        texts = [fix_text(t) for t in raw_texts]
+    enc = fetch_encoder(params)
+    return lambada_save_tokens_data(path, encode_batch(enc, texts))
+
+
+def lambada_save_tokens_data(path, arrays):
+    offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64)
+    data = np.fromiter(itertools.chain.from_iterable(arrays), dtype=np.int32, count=int(offsets[-1]))
+    atomic_save(path, lambda f: np.savez_compressed(f, data=data, offsets=offsets))
+    return data, offsets
+
 
+def lambada_tokens_npz_path(params, lt_path):
+    return f"{os.path.splitext(lt_path)[0]}_{_tokenizer_hash(params)[:8]}.npz"
 
-def lambada_read_or_create_tokens_data(params, path):
+
+def lambada_read_or_create_tokens_data(params, lt_path):
     # if you tell me where the file should go, i will helpfully create it for you
+    path = lambada_tokens_npz_path(params, lt_path)
     if not os.path.exists(path):
+        if os.path.exists(lt_path):
+            # json caches weren't keyed by tokenizer, so this assumes it was made with the current one
+            tf.compat.v1.logging.info(f"Converting lambada tokens from {lt_path} to {path}")
+            with open(lt_path) as f:
+                return lambada_save_tokens_data(path, json.load(f))
         return lambada_create_tokens_data(params, path)
-    with open(path) as f:
-        return json.load(f)
+    with np.load(path) as f:
+        return f['data'], f['offsets']
+
+
+def next_fit(lengths, n_ctx):
+    # places each document in the current bin, starting a new one whenever it doesn't fit
+    bin_ids = np.empty(len(lengths), dtype=np.int64)
+    bin_offsets = np.empty(len(lengths), dtype=np.int64)
+    n_bins = 0
+    fill = 0
+    for i, length in enumerate(lengths):
+        if n_bins == 0 or fill + length > n_ctx:
+            n_bins += 1
+            fill = 0
+        bin_ids[i] = n_bins - 1
+        bin_offsets[i] = fill
+        fill += length
+    return bin_ids, bin_offsets, n_bins
+
+
+def best_fit_decreasing(lengths, n_ctx):
+    # places documents longest first, each into the open bin with the least room left that still fits it
+    no_fit = np.iinfo(np.int64).max
+    bin_ids = np.empty(len(lengths), dtype=np.int64)
+    bin_offsets = np.empty(len(lengths), dtype=np.int64)
+    remaining = np.empty(len(lengths), dtype=np.int64)
+    n_bins = 0
+    for i in np.argsort(-lengths, kind='stable'):
+        length = lengths[i]
+        candidates = np.where(remaining[:n_bins] >= length, remaining[:n_bins], no_fit)
+        idx = int(np.argmin(candidates)) if n_bins > 0 else 0
+        if n_bins == 0 or candidates[idx] == no_fit:
+            idx = n_bins
+            remaining[idx] = n_ctx
+            n_bins += 1
+        bin_ids[i] = idx
+        bin_offsets[i] = n_ctx - remaining[idx]
+        remaining[idx] -= length
+    return bin_ids, bin_offsets, n_bins
+
+
+# 'first_fit' is the params value for next_fit, the original packing. 'best_fit' leaves less padding but reorders
+# documents, and since there is no attention reset between them, lambada metrics aren't comparable across the two
+packing_fns = {
+    'best_fit': best_fit_decreasing,
+    'first_fit': next_fit,
+}
 
 
-def bin_pack(params, tokens_data):
+def bin_pack(params, data, offsets):
     eos_token = params['eos_id']
     n_ctx = params['n_ctx']
     dummy_token = 1
     pad_batch_size = params['eval_batch_size']
-    bins = []
-    for a in tokens_data:
-        if len(bins) == 0 or len(bins[-1]) + len(a) + 1 > n_ctx:
-            bins.append([])
-        bins[-1] += a
-        bins[-1].append(eos_token)
-    while len(bins) % pad_batch_size != 0:
-        bins.append([])
-    bins_array = np.full((len(bins), n_ctx), dummy_token, dtype=np.uint16)
-    for i, b in enumerate(bins):
-        bins_array[i, 0:len(b)] = b
+    packing = params.get('packing', 'first_fit')
+    assert packing in packing_fns, f"Unknown packing algorithm '{packing}'"
+    doc_lens = np.diff(offsets)
+    bin_ids, bin_offsets, n_bins = packing_fns[packing](doc_lens + 1, n_ctx)
+    n_bins += -n_bins % pad_batch_size
+    bins_array = np.full((n_bins, n_ctx), dummy_token, dtype=np.uint16)
+    row_ids = np.repeat(bin_ids, doc_lens)
+    col_ids = np.arange(len(data)) + np.repeat(bin_offsets - offsets[:-1], doc_lens)
+    bins_array[row_ids, col_ids] = data
+    bins_array[bin_ids, bin_offsets + doc_lens] = eos_token
     return bins_array
 
 
+def lambada_bins_path(params, lt_path):
+    base, _ = os.path.splitext(lambada_tokens_npz_path(params, lt_path))
+    packing = params.get('packing', 'first_fit')
+    return f"{base}_eos{params['eos_id']}_ctx{params['n_ctx']}_bs{params['eval_batch_size']}_{packing}.npy"
+
+
+def lambada_read_or_create_bins_array(params, lt_path, bins_path):
+    if not os.path.exists(bins_path):
+        data, offsets = lambada_read_or_create_tokens_data(params, lt_path)
+        bins_array = bin_pack(params, data, offsets)
+        atomic_save(bins_path, lambda f: np.save(f, bins_array))
+    return np.load(bins_path, mmap_mode='r')
+
+
 def lambada_init(params):
     ds_configs = params['dataset_configs']
     l = [
@@ -66,11 +174,13 @@ def lambada_init(params):
     ]
     assert len(l) > 0, 'lambada_tokens_path not found in the dataset config'
     lt_path = l[0]
-    assert lt_path.endswith('.json'), 'lambada_tokens_path must have extension json'
+    assert lt_path.endswith('.json'), \
+        'lambada_tokens_path must have extension json, tokens are cached in an npz named after it and the tokenizer'
 
-    tokens_data = lambada_read_or_create_tokens_data(params, lt_path)
-    bins_array = bin_pack(params, tokens_data)
+    bins_path = lambada_bins_path(params, lt_path)
+    bins_array = lambada_read_or_create_bins_array(params, lt_path, bins_path)
     params['lambada_tokens_path'] = lt_path
+    params['lambada_bins_path'] = bins_path
     params['lambada_n_steps'] = len(bins_array) // params['eval_batch_size']
 
 
@@ -83,27 +193,21 @@ def lambada_get_task_info(params):
 # The LAMBADA evaluation code looks at the logits of each position just before an eos_token
 def lambada_input(params):
     eos_token = 50256 if params['n_vocab'] >= 50257 else 0
-    n_ctx = params['n_ctx']
-    lt_path = params['lambada_tokens_path']
-    tokens_data = lambada_read_or_create_tokens_data(params, lt_path)
-    bins_array = bin_pack(params, tokens_data)
+    bins_array = lambada_read_or_create_bins_array(params, params['lambada_tokens_path'], params['lambada_bins_path'])
+    # from_tensor_slices copies the bins into a graph constant; TPU input workers can't run a python reader over the file
     dataset = tf.data.Dataset.from_tensor_slices(bins_array)
 
-    def _get_output(bin):
-        bin = tf.cast(bin, dtype=tf.int32)
-        indexes = tf.range(n_ctx)
-        results = tf.gather(bin, (indexes + 1) % n_ctx)
-        eos_next_positions = tf.math.equal(tf.gather(bin, (indexes + 2) % n_ctx), eos_token)
-        output = tf.where(eos_next_positions, results, tf.constant(eos_token, shape=[n_ctx]))
-        bin = tf.reshape(bin, [n_ctx])
-        bin = tf.cast(bin, dtype=tf.int32)
-        output = tf.reshape(output, [n_ctx])
-        output = tf.cast(output, dtype=tf.int32)
-        return bin, output
-
-    dataset = dataset.map(_get_output)
+    def _get_output(bins):
+        # stay in uint16 (the dtype of bins_array) and only widen the final tensors
+        eos = tf.constant(eos_token, dtype=tf.uint16)
+        results = tf.roll(bins, shift=-1, axis=1)
+        eos_next_positions = tf.math.equal(tf.roll(bins, shift=-2, axis=1), eos)
+        output = tf.where(eos_next_positions, results, eos)
+        return tf.cast(bins, dtype=tf.int32), tf.cast(output, dtype=tf.int32)
+
     dataset = dataset.batch(params['eval_batch_size'], drop_remainder=True)
-    dataset = dataset.repeat()
+    dataset = dataset.map(_get_output, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    dataset = dataset.repeat().prefetch(tf.data.experimental.AUTOTUNE)
     return dataset
 
 
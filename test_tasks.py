@@ -0,0 +1,90 @@
+import os
+import random
+
+import numpy as np
+import pytest
+
+from tasks import atomic_save, bin_pack
+
+# helper functions
+
+def baseline_bin_pack(params, tokens_data):
+    # the original sequential packer, kept here as the reference for packing='first_fit'
+    eos_token = params['eos_id']
+    n_ctx = params['n_ctx']
+    dummy_token = 1
+    pad_batch_size = params['eval_batch_size']
+    bins = []
+    for a in tokens_data:
+        if len(bins) == 0 or len(bins[-1]) + len(a) + 1 > n_ctx:
+            bins.append([])
+        bins[-1] += a
+        bins[-1].append(eos_token)
+    while len(bins) % pad_batch_size != 0:
+        bins.append([])
+    bins_array = np.full((len(bins), n_ctx), dummy_token, dtype=np.uint16)
+    for i, b in enumerate(bins):
+        bins_array[i, 0:len(b)] = b
+    return bins_array
+
+
+def random_documents(seed, n_ctx):
+    rng = random.Random(seed)
+    # token ids start at 2 so they never collide with the eos (0) or dummy (1) tokens
+    return [[rng.randint(2, 1000) for _ in range(rng.randint(1, n_ctx - 1))] for _ in range(rng.randint(1, 200))]
+
+
+def flatten(tokens_data):
+    offsets = np.concatenate([[0], np.cumsum([len(a) for a in tokens_data])]).astype(np.int64)
+    data = np.array([t for a in tokens_data for t in a], dtype=np.int32)
+    return data, offsets
+
+
+def packed_documents(bins_array, eos_token):
+    # splits every row on eos, checking that only dummy tokens follow the last document in a row
+    documents = []
+    for row in bins_array:
+        current = []
+        for token in row:
+            if token == eos_token:
+                documents.append(tuple(current))
+                current = []
+            else:
+                current.append(int(token))
+        assert all(token == 1 for token in current)
+    return documents
+
+# tests
+
+@pytest.mark.parametrize("seed", range(20))
+def test_first_fit_matches_baseline(seed):
+    params = {'eos_id': 0, 'n_ctx': 32, 'eval_batch_size': 4, 'packing': 'first_fit'}
+    tokens_data = random_documents(seed, params['n_ctx'])
+    expected = baseline_bin_pack(params, tokens_data)
+    assert np.array_equal(bin_pack(params, *flatten(tokens_data)), expected)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_best_fit_keeps_documents(seed):
+    params = {'eos_id': 0, 'n_ctx': 32, 'eval_batch_size': 4, 'packing': 'best_fit'}
+    tokens_data = random_documents(seed, params['n_ctx'])
+    bins_array = bin_pack(params, *flatten(tokens_data))
+    assert len(bins_array) % params['eval_batch_size'] == 0
+    # no packing can use fewer bins than the total length needs, rounded up to whole batches
+    n_tokens = sum(len(a) + 1 for a in tokens_data)
+    min_bins = -(-n_tokens // params['n_ctx'])
+    min_bins += -min_bins % params['eval_batch_size']
+    assert len(bins_array) >= min_bins
+    assert sorted(packed_documents(bins_array, params['eos_id'])) == sorted(tuple(a) for a in tokens_data)
+
+
+def test_atomic_save_uses_umask_mode(tmp_path):
+    path = str(tmp_path / "bins.npy")
+    old_umask = os.umask(0o022)
+    try:
+        atomic_save(path, lambda f: np.save(f, np.arange(4)))
+    finally:
+        os.umask(old_umask)
+    assert os.stat(path).st_mode & 0o777 == 0o644
+    assert np.array_equal(np.load(path), np.arange(4))
+    assert os.listdir(str(tmp_path)) == ["bins.npy"]